@@ -1,35 +1,103 @@
-import re
+try:
+    import regex as re  # Drop-in replacement for re that releases the GIL while matching
+except ImportError:
+    import re
+import csv
+import io
+import mmap
+import os
+import stat
 import psycopg2
 from psycopg2 import sql, errors
+from psycopg2.extensions import make_dsn
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import argparse
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
 import socket
 import struct
 import binascii
 
-# Database connection parameters
-DB_HOST = 'dc2.grit.ucsb.edu'
-DB_USER = 'kea'
-DB_PASS = 'public.FIJI.friends.GATHER!'
-DB_NAME = 'kea'
+# Database connection parameters, overridable with the usual libpq environment variables.
+# The password is not kept here: libpq reads it from PGPASSWORD, ~/.pgpass or a PGSERVICE entry.
+DB_HOST = os.environ.get('PGHOST', 'dc2.grit.ucsb.edu')
+DB_USER = os.environ.get('PGUSER', 'kea')
+DB_NAME = os.environ.get('PGDATABASE', 'kea')
+DB_DSN = make_dsn(host=DB_HOST, user=DB_USER, dbname=DB_NAME)
+
+logger = logging.getLogger(__name__)
+
+HOSTS_COLUMNS = (
+    'dhcp_identifier', 'dhcp_identifier_type', 'dhcp4_subnet_id', 'dhcp6_subnet_id', 'ipv4_address', 'hostname',
+    'dhcp4_client_classes', 'dhcp6_client_classes', 'dhcp4_next_server', 'dhcp4_server_hostname',
+    'dhcp4_boot_file_name', 'user_context', 'auth_key'
+)
+
+# One hosts row, fields in HOSTS_COLUMNS order; much smaller than a dict per reservation.
+Lease = namedtuple('Lease', HOSTS_COLUMNS)
+
+def compile_lease_pattern(mac_pattern):
+    """Compile the host block regex around the given hardware ethernet address pattern."""
+    # A bytes pattern so it can scan the memory-mapped leases file directly. Quantifiers are possessive so a
+    # malformed host block fails fast instead of backtracking through the optional fixed-address groups;
+    # addresses stop at ';' so nothing has to be given back to match the terminator. Only the keywords are
+    # case-insensitive, as dhcpd reads them, so hostnames keep their case without a global IGNORECASE.
+    pattern = (
+        rb'(?i:host) (\S++) \{\s*+'
+        rb'(?:(?i:fixed-address) ([^\s;]++);\s*+)?+'
+        rb'(?i:hardware ethernet) (' + mac_pattern + rb');\s*+'
+        rb'(?:(?i:fixed-address) ([^\s;]++);\s*+)?+\}'
+    )
+    try:
+        return re.compile(pattern, re.DOTALL)
+    except re.error:
+        # Possessive quantifiers need Python 3.11+ or the regex module; the greedy form matches the same hosts.
+        return re.compile(pattern.replace(b'++', b'+').replace(b'*+', b'*').replace(b'?+', b'?'), re.DOTALL)
+
+# Compiled once at import time rather than on every parse_dhcp_leases call, keyed by --lease-format.
+LEASE_RES = {
+    'strict': compile_lease_pattern(rb'[\da-fA-F:]{17}'),  # Canonical aa:bb:cc:dd:ee:ff MACs only
+    'legacy': compile_lease_pattern(rb'(?:[\da-fA-F]{1,2}:){5}[\da-fA-F]{1,2}'),  # Also unpadded, e.g. 0:1:a:b:c:d
+}
+
+# Lines that open a host block; parallel parsing only splits the file at these, so no match straddles two chunks.
+HOST_START_RE = re.compile(rb'^[ \t]*(?i:host) ', re.MULTILINE)
+
+# Files smaller than this are always parsed in-process; worker start-up would cost more than it saves.
+PARALLEL_PARSE_MIN_BYTES = 1 << 20
 
 
 def ip_to_int(ip):
     """Convert a dotted-decimal IP address to an integer."""
-    return struct.unpack("!I", socket.inet_aton(ip))[0] if ip else 0
+    return int.from_bytes(socket.inet_aton(ip), 'big') if ip else 0
 
 def subnet_lookup(ip_address, subnet_map):
-    """Determine the subnet ID based on IP address using a provided subnet map."""
-    print(f"Looking up subnet for IP address: {ip_address}")
-    if ip_address:
-        for prefix, subnet_id in subnet_map.items():
-            if ip_address.startswith(prefix):
-                print(f"Match found - Prefix: {prefix}, Subnet ID: {subnet_id}")
-                return subnet_id, None
-    print("No subnet match found.")
+    """Determine the subnet ID based on IP address using a provided subnet map. ip_address must not be empty."""
+    logger.debug("Looking up subnet for IP address: %s", ip_address)
+    # Try the address truncated to 4, 3, 2 and 1 octets so the longest mapped prefix wins,
+    # with one dict lookup per truncation instead of a startswith() scan over every prefix.
+    octets = ip_address.split('.')
+    for length in range(len(octets), 0, -1):
+        prefix = '.'.join(octets[:length])
+        subnet_id = subnet_map.get(prefix)
+        if subnet_id is not None:
+            logger.debug("Match found - Prefix: %s, Subnet ID: %s", prefix, subnet_id)
+            return subnet_id, None
+    logger.debug("No subnet match found.")
     return None, None
 
 def mac_to_bytea(mac):
     """Convert a MAC address string to a binary format for PostgreSQL bytea field, ensuring proper octet formatting."""
+    # Fast path for canonical aa:bb:cc:dd:ee:ff addresses; anything else needs its octets padded first.
+    if len(mac) == 17 and mac[2::3] == ':::::':
+        try:
+            return bytes.fromhex(mac.replace(':', ''))
+        except ValueError:
+            pass
+
     # Split the MAC address into parts based on colons.
     parts = mac.split(':')
 
@@ -44,105 +112,263 @@ def mac_to_bytea(mac):
         raise
 
 def parse_subnet_mappings(subnet_strings):
+    """Build a dict of whole-octet IP prefixes (e.g. '192.168.0') to subnet IDs."""
     subnet_map = {}
     if subnet_strings:  # Ensure it's not None
         for s in subnet_strings:
             parts = s.split('=')
             if len(parts) == 2:
-                subnet_map[parts[0]] = int(parts[1])
+                subnet_map[parts[0].rstrip('.')] = int(parts[1])
     else:
         print("Warning: No subnet mappings provided.")
     return subnet_map
 
 
 
-def parse_dhcp_leases(file_path, no_ip_client_class, default_subnet_id, subnet_map):
-    leases = []
-    with open(file_path, 'r') as file:
-        content = file.read()
-    lease_pattern = re.compile(
-        r'host (\S+) \{\s*'
-        r'(?:fixed-address (\S+);\s*)?'
-        r'hardware ethernet ([\da-fA-F:]{17});\s*'  # More specific pattern for MAC addresses
-        r'(?:fixed-address (\S+);\s*)?\}',
-        re.IGNORECASE | re.DOTALL
-    )
+def scan_lease_matches(content, start, end, lease_format):
+    """Yield (hostname, fixed_address, hwaddr) for each host block in a bytes-like buffer."""
+    # finditer yields matches lazily instead of building a list of every match up front.
+    for match in LEASE_RES[lease_format].finditer(content, start, len(content) if end is None else end):
+        fixed_address = match.group(2) or match.group(4)
+        yield (
+            match.group(1).decode(),
+            fixed_address.decode() if fixed_address else None,
+            match.group(3).decode()
+        )
+
+def iter_lease_matches(file_path, start=0, end=None, lease_format='strict'):
+    """Yield (hostname, fixed_address, hwaddr) for each host block, scanning regular files via mmap."""
+    with open(file_path, 'rb') as file:
+        file_stat = os.fstat(file.fileno())
+        if not stat.S_ISREG(file_stat.st_mode):
+            # Pipes and other non-regular files (e.g. /dev/stdin) cannot be mapped, so read them instead.
+            yield from scan_lease_matches(file.read(), start, end, lease_format)
+            return
+        if file_stat.st_size == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from scan_lease_matches(mm, start, end, lease_format)
+
+def parse_lease_chunk(chunk):
+    """Worker entry point: return the lease matches in one (file_path, start, end, lease_format) byte range."""
+    file_path, start, end, lease_format = chunk
+    return list(iter_lease_matches(file_path, start, end, lease_format))
 
-    matches = lease_pattern.findall(content)
-    for match in matches:
-        hostname, fixed_address1, hwaddr, fixed_address2 = match
-        fixed_address = fixed_address1 or fixed_address2
-        print("Match Details:", match)
+def lease_chunk_ranges(file_path, count):
+    """Split the file into up to `count` byte ranges, each starting at the beginning of a host block."""
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        boundaries = [0]
+        for i in range(1, count):
+            match = HOST_START_RE.search(mm, max(size * i // count, boundaries[-1] + 1))
+            if not match:
+                break
+            boundaries.append(match.start())
+        boundaries.append(size)
+    return [(file_path, start, end) for start, end in zip(boundaries, boundaries[1:])]
 
-        # This call can return (None, None)
-        dhcp4_subnet_id, dhcp6_subnet_id = subnet_lookup(fixed_address, subnet_map)
+def iter_lease_matches_parallel(file_path, workers, lease_format='strict'):
+    """Like iter_lease_matches, but scans chunks of the file in `workers` processes."""
+    chunks = [chunk + (lease_format,) for chunk in lease_chunk_ranges(file_path, workers)]
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        # map() keeps the chunks in file order, so leases come out in the same order as a serial scan.
+        yield from itertools.chain.from_iterable(executor.map(parse_lease_chunk, chunks))
+
+def parse_dhcp_leases(file_path, no_ip_client_class, default_subnet_id, subnet_map, debug=False, workers=1,
+                      lease_format='strict'):
+    leases = []
+    # Only regular files can be split into ranges and reopened by the workers.
+    if workers > 1 and os.path.isfile(file_path) and os.path.getsize(file_path) >= PARALLEL_PARSE_MIN_BYTES:
+        matches = iter_lease_matches_parallel(file_path, workers, lease_format)
+    else:
+        matches = iter_lease_matches(file_path, lease_format=lease_format)
+    for hostname, fixed_address, hwaddr in matches:
+        if debug:
+            print("Match Details:", (hostname, fixed_address, hwaddr))
+
+        if fixed_address:
+            # This call can return (None, None)
+            dhcp4_subnet_id, dhcp6_subnet_id = subnet_lookup(fixed_address, subnet_map)
+        else:
+            dhcp4_subnet_id, dhcp6_subnet_id = None, None  # Class-only reservation, nothing to look up
 
         # Ensure dhcp4_subnet_id is not None before using it
         if dhcp4_subnet_id is None:
             dhcp4_subnet_id = default_subnet_id  # Use the default subnet ID if None
-            print(f"No specific subnet ID found, using default: {default_subnet_id}")
+            if debug:
+                print(f"No specific subnet ID found, using default: {default_subnet_id}")
 
         ipv4_int_address = ip_to_int(fixed_address) if fixed_address else 0
 
-        lease = {
-            'dhcp_identifier': hwaddr,
-            'dhcp_identifier_type': 0,
-            'dhcp4_subnet_id': dhcp4_subnet_id,
-            'dhcp6_subnet_id': dhcp6_subnet_id,
-            'ipv4_address': ipv4_int_address,
-            'hostname': hostname,
-            'dhcp4_client_classes': None if fixed_address else no_ip_client_class,
-            'dhcp6_client_classes': '',
-            'dhcp4_next_server': 0,
-            'dhcp4_server_hostname': '',
-            'dhcp4_boot_file_name': '',
-            'user_context': '',
-            'auth_key': ''
-        }
+        lease = Lease(
+            dhcp_identifier=mac_to_bytea(hwaddr),  # Converted once here, not again at insert time
+            dhcp_identifier_type=0,
+            dhcp4_subnet_id=dhcp4_subnet_id,
+            dhcp6_subnet_id=dhcp6_subnet_id,
+            ipv4_address=ipv4_int_address,
+            hostname=hostname,
+            dhcp4_client_classes=None if fixed_address else no_ip_client_class,
+            dhcp6_client_classes='',
+            dhcp4_next_server=0,
+            dhcp4_server_hostname='',
+            dhcp4_boot_file_name='',
+            user_context='',
+            auth_key=''
+        )
         leases.append(lease)
     return leases
 
-def insert_leases_to_db(leases, dry_run=False, debug=False):
+def lease_to_csv_field(value):
+    """Render a single lease value the way PostgreSQL's CSV COPY expects it."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()  # bytea hex input format
+    return value
+
+def copy_leases(cursor, leases, debug=False):
+    """Stream all leases into the hosts table with a single COPY ... FROM STDIN."""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    for lease in leases:
+        if debug:
+            print(lease)  # Debug output
+        writer.writerow([lease_to_csv_field(value) for value in lease])
+    buf.seek(0)
+
+    copy_query = sql.SQL("COPY hosts ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+        sql.SQL(', ').join(sql.Identifier(column) for column in HOSTS_COLUMNS)
+    )
+    cursor.copy_expert(copy_query, buf)
+
+# Binary COPY framing: signature, flags and header extension length, then a -1 field count as the trailer.
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('!h', -1)
+
+# Binary COPY is strict about widths, so integers are packed to the exact type of each hosts column.
+BINARY_INT_FORMATS = {'int2': struct.Struct('!h'), 'int4': struct.Struct('!i'), 'int8': struct.Struct('!q')}
+BINARY_TEXT_TYPES = {'text', 'varchar', 'bpchar'}
+
+def hosts_column_types(cursor):
+    """Return the PostgreSQL type name of every column in the hosts table."""
+    cursor.execute("""
+    SELECT a.attname, t.typname
+    FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+    WHERE a.attrelid = 'hosts'::regclass AND a.attnum > 0 AND NOT a.attisdropped
+    """)
+    return dict(cursor.fetchall())
+
+def binary_field_encoders(column_types, encoding):
+    """Build one value -> bytes encoder per entry of HOSTS_COLUMNS for the binary COPY format."""
+    encoders = []
+    for column in HOSTS_COLUMNS:
+        type_name = column_types.get(column)
+        if type_name in BINARY_INT_FORMATS:
+            encoders.append(BINARY_INT_FORMATS[type_name].pack)
+        elif type_name == 'bytea':
+            encoders.append(bytes)
+        elif type_name in BINARY_TEXT_TYPES:
+            encoders.append(lambda value: value.encode(encoding))
+        else:
+            raise ValueError(f"Cannot encode hosts.{column} of type {type_name} for binary COPY")
+    return encoders
+
+def copy_leases_binary(cursor, leases, debug=False):
+    """Stream all leases into the hosts table with a single binary-format COPY ... FROM STDIN."""
+    encoding = psycopg2.extensions.encodings[cursor.connection.encoding]
+    encoders = binary_field_encoders(hosts_column_types(cursor), encoding)
+    row_header = struct.pack('!h', len(HOSTS_COLUMNS))
+    null_field = struct.pack('!i', -1)
+    pack_length = struct.Struct('!i').pack
+
+    buf = io.BytesIO()
+    buf.write(BINARY_COPY_HEADER)
+    for lease in leases:
+        if debug:
+            print(lease)  # Debug output
+        buf.write(row_header)
+        for encode, value in zip(encoders, lease):
+            if value is None:
+                buf.write(null_field)
+            else:
+                data = encode(value)
+                buf.write(pack_length(len(data)))
+                buf.write(data)
+    buf.write(BINARY_COPY_TRAILER)
+    buf.seek(0)
+
+    copy_query = sql.SQL("COPY hosts ({}) FROM STDIN WITH (FORMAT binary)").format(
+        sql.SQL(', ').join(sql.Identifier(column) for column in HOSTS_COLUMNS)
+    )
+    cursor.copy_expert(copy_query, buf)
+
+def insert_leases_batched(cursor, leases, debug=False):
+    """Insert leases with multi-row INSERT statements; used when COPY is not available."""
+    insert_query = sql.SQL("""
+    INSERT INTO hosts (dhcp_identifier, dhcp_identifier_type, dhcp4_subnet_id, dhcp6_subnet_id, ipv4_address, hostname,
+                        dhcp4_client_classes, dhcp6_client_classes, dhcp4_next_server, dhcp4_server_hostname, dhcp4_boot_file_name,
+                        user_context, auth_key)
+    VALUES %s
+    """)
+
+    if debug:
+        for lease in leases:
+            print(lease)  # Debug output
+    # Lease fields are already in column order, so each lease is passed as the row tuple as-is.
+    # One INSERT per 1000 rows instead of one round-trip per lease. This is psycopg2's closest
+    # equivalent of psycopg 3's pipeline mode, which would need the whole load moved to the newer driver.
+    execute_values(cursor, insert_query, leases, page_size=1000)
+
+def load_leases(conn, leases, debug=False):
+    """Load leases over one connection in a single transaction, trying binary COPY, then CSV COPY, then batched INSERTs."""
+    loaders = (copy_leases_binary, copy_leases, insert_leases_batched)
+    with conn.cursor() as cursor:
+        for i, loader in enumerate(loaders):
+            # The load runs in one transaction; skip waiting on the WAL flush for its commit.
+            # SET LOCAL only lasts for the current transaction, so it is repeated after a rollback.
+            cursor.execute("SET LOCAL synchronous_commit = OFF")
+            try:
+                loader(cursor, leases, debug=debug)
+                break
+            except (psycopg2.Error, ValueError, struct.error) as e:
+                if i == len(loaders) - 1:
+                    raise
+                print(f"{loader.__name__} failed, falling back to {loaders[i + 1].__name__}: {e}")
+                conn.rollback()
+    conn.commit()
+
+def load_leases_from_pool(pool, leases, debug=False):
+    """Writer thread entry point: load one chunk of leases on a connection borrowed from the pool."""
+    conn = pool.getconn()
+    try:
+        load_leases(conn, leases, debug=debug)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+def insert_leases_to_db(leases, dry_run=False, debug=False, writers=1):
     conn = None
-    cursor = None
+    pool = None
 
     try:
         if dry_run:
             for lease in leases:
-                lease['dhcp_identifier'] = mac_to_bytea(lease['dhcp_identifier'])
                 print("DRY RUN - Would insert:", lease)
             return  # Exit the function after dry run output
 
-        conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
-        cursor = conn.cursor()
-
-        insert_query = sql.SQL("""
-        INSERT INTO hosts (dhcp_identifier, dhcp_identifier_type, dhcp4_subnet_id, dhcp6_subnet_id, ipv4_address, hostname,
-                            dhcp4_client_classes, dhcp6_client_classes, dhcp4_next_server, dhcp4_server_hostname, dhcp4_boot_file_name,
-                            user_context, auth_key)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """)
-
-        for lease in leases:
-            if debug:
-                print(lease)  # Debug output
-            lease['dhcp_identifier'] = mac_to_bytea(lease['dhcp_identifier'])  # Convert MAC address to binary before insertion
-            cursor.execute(insert_query, (
-                lease['dhcp_identifier'],
-                lease['dhcp_identifier_type'],
-                lease['dhcp4_subnet_id'],
-                lease['dhcp6_subnet_id'],
-                lease['ipv4_address'],
-                lease['hostname'],
-                lease['dhcp4_client_classes'],
-                lease['dhcp6_client_classes'],
-                lease['dhcp4_next_server'],
-                lease['dhcp4_server_hostname'],
-                lease['dhcp4_boot_file_name'],
-                lease['user_context'],
-                lease['auth_key']
-            ))
-        conn.commit()
+        if writers > 1:
+            # A single backend runs COPY serially, so split the leases across several connections.
+            # Each writer commits its own chunk; a failure in one does not roll back the others.
+            pool = ThreadedConnectionPool(1, writers, DB_DSN)
+            chunk_size = max(1, -(-len(leases) // writers))
+            chunks = [leases[i:i + chunk_size] for i in range(0, len(leases), chunk_size)]
+            with ThreadPoolExecutor(max_workers=writers) as executor:
+                list(executor.map(lambda chunk: load_leases_from_pool(pool, chunk, debug=debug), chunks))
+        else:
+            conn = psycopg2.connect(DB_DSN)
+            load_leases(conn, leases, debug=debug)
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -150,10 +376,10 @@ def insert_leases_to_db(leases, dry_run=False, debug=False):
             conn.rollback()
 
     finally:
-        if cursor:
-            cursor.close()
         if conn:
             conn.close()
+        if pool:
+            pool.closeall()
 
 def main():
     parser = argparse.ArgumentParser(description='Process DHCP leases and optionally perform a dry run.')
@@ -166,12 +392,22 @@ def main():
     parser.add_argument('--default-subnet-id', type=int, default=0, help='Default subnet ID to use when none is found.')
     parser.add_argument('--subnet-map', action='append',
                         help='Add subnet mapping in the format prefix=subnet_id e.g., 128.111.106=3')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help='Number of processes to parse large leases files with.')
+    parser.add_argument('--db-writers', type=int, default=1,
+                        help='Number of database connections to load leases over in parallel.')
+    parser.add_argument('--lease-format', choices=sorted(LEASE_RES), default='strict',
+                        help='strict only accepts aa:bb:cc:dd:ee:ff MACs; legacy also accepts unpadded octets.')
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format='%(message)s')
+
     subnet_map = parse_subnet_mappings(args.subnet_map if args.subnet_map else [])
 
-    leases = parse_dhcp_leases(args.file_path, args.no_ip_client_class, args.default_subnet_id, subnet_map)
-    insert_leases_to_db(leases, dry_run=args.dry_run, debug=args.debug)
+    leases = parse_dhcp_leases(args.file_path, args.no_ip_client_class, args.default_subnet_id, subnet_map,
+                               debug=args.debug, workers=args.parse_workers,
+                               lease_format=args.lease_format)
+    insert_leases_to_db(leases, dry_run=args.dry_run, debug=args.debug, writers=args.db_writers)
 
 if __name__ == '__main__':
     main()